@@ -20,10 +20,8 @@ def buy_and_sell(stocks, start_date, end_date, starting_balance=100000):
             df = df[(df["Date"] >= start_date) & (df["Date"] <= end_date)]
 
         # We only need closing prices
-        df = df[["Date", "Close"]]
-        df["Date"] = pd.to_datetime(df["Date"], format="%Y-%m-%d")
-        df.set_index("Date", inplace=True)
-        dfs.append(df)
+        # The dates are never used, so skip parsing them and keep a plain 0..n index for the lookups below
+        dfs.append(df[["Close"]].reset_index(drop=True))
 
     # Allocate equal amount of money to each stock
     num_stocks = len(dfs)
@@ -0,0 +1,138 @@
+import numpy as np
+from gym import spaces
+from numba import njit
+from stable_baselines3.common.vec_env import VecEnv
+from custom_environment_multistock import _trade_kernel
+
+
+@njit(cache=True)
+def _batched_trade_kernel(actions, current_price, account_balance, num_shares, total_portfolio_value, k):
+    '''
+    Run _trade_kernel from custom_environment_multistock.py for every copy, so both envs trade by the same code.
+    actions and num_shares have shape (num_envs, num_stocks), account_balance and total_portfolio_value shape (num_envs,).
+    Returns the new account balances, numbers of shares, total portfolio values and the number of trades made by each copy.
+    '''
+    num_envs = actions.shape[0]
+    new_account_balance = np.empty(num_envs)
+    new_num_shares = np.empty_like(num_shares)
+    new_total_portfolio_value = np.empty(num_envs)
+    trades = np.empty(num_envs, dtype=np.int64)
+    for n in range(num_envs):
+        balance, shares, value, trades_made = _trade_kernel(
+            actions[n], current_price, account_balance[n], num_shares[n], total_portfolio_value[n], k)
+        new_account_balance[n] = balance
+        new_num_shares[n] = shares
+        new_total_portfolio_value[n] = value
+        trades[n] = trades_made
+    return new_account_balance, new_num_shares, new_total_portfolio_value, trades
+
+
+# Compile the kernel on import rather than on the first step of training
+_batched_trade_kernel(np.zeros((1, 1)), np.ones(1), np.ones(1), np.zeros((1, 1), dtype=np.int64), np.ones(1), 1.0)
+
+
+class BatchedStockEnv(VecEnv):
+    def __init__(self, data, num_envs=1, window_size=10, k=1000, num_features=6, starting_balance=100000):
+        '''
+        Same trading rules as CustomStockTradingEnv in custom_environment_multistock.py, but num_envs copies
+        of the portfolio are kept as arrays and stepped together in one compiled loop instead of one Python env per copy.
+        data: array of shape (num_stocks, num_days, num_features), see CustomStockTradingEnv
+        num_envs: number of portfolios to simulate at once
+        window_size: number of previous days to consider
+        k: max number of shares to buy or sell
+        num_features: number of features to consider (i.e. Number of columns in dataframe not including date)
+        starting_balance: starting balance of account
+        '''
+        # Every step is just a slice of this, shape (num_stocks, num_days, num_features)
+        self.data = np.ascontiguousarray(data, dtype=np.float32)
+        self.num_stocks, self.num_days = self.data.shape[0], self.data.shape[1]
+        # Closing prices, shape (num_days, num_stocks), in float64 like the account (see CustomStockTradingEnv._get_current_price)
+        self.prices = np.ascontiguousarray(self.data[:, :, 0].T, dtype=np.float64)
+        self.window_size = window_size
+        self.k = k
+        self.starting_balance = starting_balance
+        action_space = spaces.Box(low=-1, high=1, shape=(self.num_stocks, 1,), dtype=np.float32)
+        observation_space = spaces.Box(low=-k, high=k, shape=(self.num_stocks, window_size, num_features), dtype=np.float32)
+        super().__init__(num_envs, observation_space, action_space)
+        self.actions = None
+        self.reset()
+
+    def reset(self):
+        '''
+        Same lists as CustomStockTradingEnv, except every entry is an array with one value per copy:
+        self.account_balance: list of arrays of shape (num_envs,)
+        self.num_shares: list of arrays of shape (num_envs, num_stocks)
+        self.total_portfolio_value: list of arrays of shape (num_envs,)
+        '''
+        self.current_step = self.window_size
+        # Balances stay in float64 so cents are not lost on a 100000 account
+        self.total_portfolio_value = [np.full(self.num_envs, self.starting_balance, dtype=np.float64)]
+        self.account_balance = [np.full(self.num_envs, self.starting_balance, dtype=np.float64)]
+        self.num_shares = [np.zeros((self.num_envs, self.num_stocks), dtype=np.int64)]
+        self.rewards = np.zeros(self.num_envs, dtype=np.float32) # Running sum of the clipped rewards
+        self.trades = np.zeros(self.num_envs, dtype=np.int64)
+        return self._next_observation()
+
+    def _next_observation(self):
+        # All the copies are on the same day, so they share one window of shape (num_stocks, window_size, num_features)
+        obs = self.data[:, self.current_step - self.window_size:self.current_step, :]
+        return np.repeat(obs[np.newaxis], self.num_envs, axis=0)
+
+    def step_async(self, actions):
+        self.actions = actions
+
+    def step_wait(self):
+        # In float64 like CustomStockTradingEnv, so actions * k truncates to the same number of shares
+        self._take_action(np.asarray(self.actions, dtype=np.float64).reshape(self.num_envs, self.num_stocks))
+
+        self.current_step += 1
+        done = self.current_step >= self.num_days - 1
+
+        obs = self._next_observation()
+        rewards = self.rewards.copy()
+        dones = np.full(self.num_envs, done)
+        if done:
+            # Hand back the history of each copy, then start over like DummyVecEnv does
+            account_balance = np.array(self.account_balance) # Shape (num_iterations, num_envs)
+            num_shares = np.array(self.num_shares) # Shape (num_iterations, num_envs, num_stocks)
+            total_portfolio_value = np.array(self.total_portfolio_value) # Shape (num_iterations, num_envs)
+            infos = [{"account_balance": list(account_balance[:, i]),
+                      "num_shares": list(num_shares[:, i]),
+                      "total_portfolio_value": list(total_portfolio_value[:, i]),
+                      "terminal_observation": obs[i]} for i in range(self.num_envs)]
+            obs = self.reset()
+        else:
+            infos = [{} for _ in range(self.num_envs)]
+        return obs, rewards, dones, infos
+
+    def _take_action(self, actions):
+        current_price = self.prices[self.current_step] # The closing price for the day, shape (num_stocks,)
+
+        new_account_balance, new_num_shares, new_total_portfolio_value, trades = _batched_trade_kernel(
+            actions, current_price, self.account_balance[-1], self.num_shares[-1], self.total_portfolio_value[-1], float(self.k))
+        self.trades += trades
+
+        self.account_balance.append(new_account_balance)
+        self.num_shares.append(new_num_shares)
+        self.total_portfolio_value.append(new_total_portfolio_value)
+        self.rewards += np.clip(self.total_portfolio_value[-1] - self.total_portfolio_value[-2], -1, 1)
+
+    def close(self):
+        pass
+
+    def seed(self, seed=None):
+        # The market data is fixed, so there is nothing random to seed
+        return [None for _ in range(self.num_envs)]
+
+    # Every copy lives in this one object, so attributes and methods are shared rather than looked up per copy
+    def get_attr(self, attr_name, indices=None):
+        return [getattr(self, attr_name) for _ in self._get_indices(indices)]
+
+    def set_attr(self, attr_name, value, indices=None):
+        setattr(self, attr_name, value)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        return [getattr(self, method_name)(*method_args, **method_kwargs) for _ in self._get_indices(indices)]
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        return [False for _ in self._get_indices(indices)]
@@ -1,22 +1,74 @@
 import gym
 import numpy as np
 from gym import spaces
+from numba import njit
+
+# The order of the features along the last axis of the data passed to the env
+FEATURES = ["Close", "MACD", "Signal", "RSI", "CCI", "ADX"]
+
+
+@njit(cache=True)
+def _trade_kernel(actions, current_price, account_balance, num_shares, total_portfolio_value, k):
+    '''
+    The buy/sell/hold arithmetic of CustomStockTradingEnv._take_action, compiled with Numba.
+    Returns the new account balance, number of shares, total portfolio value and the number of trades made.
+    '''
+    # Append these after looping through all the stocks during this iteration
+    new_account_balance = account_balance # Scalar
+    new_num_shares = num_shares.copy() # Array
+    new_total_portfolio_value = total_portfolio_value # Scalar
+    trades = 0
+
+    # Loop through each stock and perform buy/sell action
+    for i in range(len(actions)): # For each stock, do the same thing as for single-stock training
+        # Buy if action > 0 and if you have enough money
+        if actions[i] > 0 and new_account_balance > current_price[i]:
+            # Convert float to number of shares based on set "k" value (max number of shares to buy)
+            # If you don't have enough money, just buy as many as you can
+            shares_bought = min(int(new_account_balance / current_price[i]), int(actions[i] * k))
+            new_account_balance -= shares_bought * current_price[i]
+            new_num_shares[i] += shares_bought # This is the new number of shares for this stock
+            new_total_portfolio_value += shares_bought * current_price[i]
+            trades += 1
+
+        # Sell if action < 0 and if you have enough shares
+        elif actions[i] < 0 and new_num_shares[i] > 0:
+            # Convert float to number of shares based on set "k" value (max number of shares to sell)
+            # If you don't have enough shares, just sell as many as you can
+            shares_sold = min(new_num_shares[i], int(-actions[i] * k)) # Min because actions[i] is negative
+            new_account_balance += shares_sold * current_price[i]
+            new_num_shares[i] -= shares_sold # This is the new number of shares for this stock
+            new_total_portfolio_value -= shares_sold * current_price[i]
+            trades += 1
+
+        # Otherwise, just hold
+        else:
+            new_total_portfolio_value += new_num_shares[i] * current_price[i]
+
+    return new_account_balance, new_num_shares, new_total_portfolio_value, trades
+
+
+# Compile the kernel on import rather than on the first step of training
+_trade_kernel(np.zeros(1), np.ones(1), 1.0, np.zeros(1, dtype=np.int64), 1.0, 1.0)
 
 
 class CustomStockTradingEnv(gym.Env):
-    def __init__(self, dfs, window_size=10, k=1000, num_features=6, starting_balance=100000):
+    def __init__(self, data, window_size=10, k=1000, num_features=6, starting_balance=100000):
         '''
-        df: dataframe of multiple stocks concatenated together (shape (num_stocks, num_days, num_features))
+        data: array of multiple stocks stacked together (shape (num_stocks, num_days, num_features)),
+              with the features in the order of FEATURES (see build_feature_tensor in train_multi_stock.py)
         window_size: number of previous days to consider
         k: max number of shares to buy or sell
         num_features: number of features to consider (i.e. Number of columns in dataframe not including date)
         starting_balance: starting balance of account - the higher this is, the more leeway the agent has to make mistakes and learn
         __init__ should initialize the action space and observation space        
         '''
-        self.dfs = dfs
+        # Matches the observation space, and does not copy an array that is already float32 (e.g. a view into shared memory)
+        self.data = np.ascontiguousarray(data, dtype=np.float32)
         self.window_size = window_size
         self.k = k
-        self.num_stocks = len(dfs) # Number of stocks in the portfolio
+        self.num_stocks = self.data.shape[0] # Number of stocks in the portfolio
+        self.num_days = self.data.shape[1] # Number of days in the dataset
         self.action_space = spaces.Box(low=-1, high=1, shape=(self.num_stocks, 1,), dtype=np.float32)
         self.observation_space = spaces.Box(low=-k, high=k, shape=(self.num_stocks, window_size, num_features), dtype=np.float32)
         self.starting_balance = starting_balance
@@ -39,43 +91,40 @@ class CustomStockTradingEnv(gym.Env):
 
         # This is the total number of shares owned for each stock for each iteration
         # It will have shape (num_iterations, num_stocks)
-        zeros_list = [0] * self.num_stocks
-        self.num_shares = [zeros_list]
+        self.num_shares = [np.zeros(self.num_stocks, dtype=np.int64)]
         self.trades = 0 # Extra variable to track number of trades
 
         # Technical indicators - we want them in shape (num_stocks, num_iterations)
-        self.prices = np.array([df["Close"].values for df in self.dfs])
-        self.macd = np.array([df["MACD"].values for df in self.dfs])
-        self.signal = np.array([df["Signal"].values for df in self.dfs])
-        self.rsi = np.array([df["RSI"].values for df in self.dfs])
-        self.cci = np.array([df["CCI"].values for df in self.dfs])
-        self.adx = np.array([df["ADX"].values for df in self.dfs])
+        # These are views into self.data, so nothing is copied
+        self.prices = self.data[:, :, 0]
+        self.macd = self.data[:, :, 1]
+        self.signal = self.data[:, :, 2]
+        self.rsi = self.data[:, :, 3]
+        self.cci = self.data[:, :, 4]
+        self.adx = self.data[:, :, 5]
         return self._next_observation()
     
     def _next_observation(self):
-        # We need the obs to be of shape (window_size, num_features, num_stocks)
-        # obs starts off as shape (num_features, num_stocks, window_size)
-        obs = np.array([self.prices[:, self.current_step - self.window_size:self.current_step],
-                        self.macd[:, self.current_step - self.window_size:self.current_step],
-                        self.signal[:, self.current_step - self.window_size:self.current_step],
-                        self.rsi[:, self.current_step - self.window_size:self.current_step],
-                        self.cci[:, self.current_step - self.window_size:self.current_step],
-                        self.adx[:, self.current_step - self.window_size:self.current_step]])
-        return np.transpose(obs, (1, 2, 0))
+        # We need the obs to be of shape (num_stocks, window_size, num_features), which is how self.data is laid out,
+        # so the window is just a view into it instead of being rebuilt from each indicator every step
+        return self.data[:, self.current_step - self.window_size:self.current_step, :]
     
     def step(self, action):
         self._take_action(action)
 
         self.current_step += 1
 
-        # np.array(self.dfs).shape[1] is the number of days in the dataset
-        if self.current_step >= np.array(self.dfs).shape[1] - 1:
+        if self.current_step >= self.num_days - 1:
             done = True
         else:
             done = False
 
         obs = self._next_observation()
-        return obs, sum(self.rewards), done, {"account_balance": self.account_balance, "num_shares": self.num_shares, "total_portfolio_value": self.total_portfolio_value}
+        if done:
+            info = {"account_balance": self.account_balance, "num_shares": self.num_shares, "total_portfolio_value": self.total_portfolio_value}
+        else:
+            info = {} # Only send the history once, SubprocVecEnv would otherwise pickle it every step
+        return obs, sum(self.rewards), done, info
     
     def calculate_reward(self):
         '''
@@ -95,42 +144,12 @@ class CustomStockTradingEnv(gym.Env):
     
     def _take_action(self, action):
         current_price = self._get_current_price() # The closing price for the day (list of size (num_stocks, 1))
-        actions = action # Should be a list of floats between -1 and 1
-
-        # Append these after looping through all the stocks during this iteration
-        new_account_balance = self.account_balance[-1] # Scalar
-        new_num_shares = self.num_shares[-1].copy() # List
-        new_total_portfolio_value = self.total_portfolio_value[-1] # Scalar
-        # print(new_total_portfolio_value, new_account_balance, new_num_shares)
-
-        # Loop through each stock and perform buy/sell action
-        for i in range(len(actions)): # For each stock, do the same thing as for single-stock training
-            # print(new_account_balance) # The balance never goes negative, so I know the model isn't cheating...
-            # Buy if action > 0 and if you have enough money
-            if actions[i] > 0 and new_account_balance > current_price[i]:
-                # Convert float to number of shares based on set "k" value (max number of shares to buy)
-                # If you don't have enough money, just buy as many as you can
-                shares_bought = min(int(new_account_balance / current_price[i]), int(actions[i] * self.k))
-                new_account_balance -= shares_bought * current_price[i]
-                new_num_shares[i] += shares_bought # This is the new number of shares for this stock
-                new_total_portfolio_value += shares_bought * current_price[i]
-                self.trades += 1
-                
-            # Sell if action < 0 and if you have enough shares
-            elif actions[i] < 0 and new_num_shares[i] > 0:
-                # Convert float to number of shares based on set "k" value (max number of shares to sell)
-                # If you don't have enough shares, just sell as many as you can
-                shares_sold = min(new_num_shares[i], int(-actions[i] * self.k)) # Min because actions[i] is negative
-                new_account_balance += shares_sold * current_price[i]
-                new_num_shares[i] -= shares_sold # This is the new number of shares for this stock
-                new_total_portfolio_value -= shares_sold * current_price[i]
-                self.trades += 1
-            
-            # Otherwise, just hold
-            else:
-                # new_account_balance += 0
-                # new_num_shares[i] = new_num_shares[i]
-                new_total_portfolio_value += new_num_shares[i] * current_price[i]
+        actions = np.asarray(action, dtype=np.float64).reshape(-1) # Should be a list of floats between -1 and 1
+
+        new_account_balance, new_num_shares, new_total_portfolio_value, trades = _trade_kernel(
+            actions, current_price, float(self.account_balance[-1]), self.num_shares[-1],
+            float(self.total_portfolio_value[-1]), float(self.k))
+        self.trades += trades
         
         # Append the new values to the lists
         self.account_balance.append(new_account_balance)
@@ -142,4 +161,5 @@ class CustomStockTradingEnv(gym.Env):
         '''
         Return the closing prices for each stock at the current step
         '''
-        return self.prices[:, self.current_step]
\ No newline at end of file
+        # The features are float32, but the account is kept in float64 so cents are not lost
+        return self.prices[:, self.current_step].astype(np.float64)
\ No newline at end of file
@@ -1,34 +1,222 @@
 import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from multiprocessing import shared_memory
+# Each SubprocVecEnv worker would otherwise spin up a full OpenMP/MKL thread pool, and the
+# small MlpPolicy gains nothing from them, so use one thread per process (set before torch is imported)
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
 import pandas as pd
 import numpy as np
+import torch as th
+th.set_num_threads(1)
+import matplotlib
+matplotlib.use("Agg") # Plots are only saved to file, so skip the interactive backend
 import matplotlib.pyplot as plt
 from stable_baselines3 import A2C, PPO
 from stable_baselines3.common.callbacks import EvalCallback
-from stable_baselines3.common.vec_env import DummyVecEnv
-from custom_environment_multistock import CustomStockTradingEnv
+from stable_baselines3.common.policies import ActorCriticPolicy
+from stable_baselines3.common.utils import set_random_seed
+from stable_baselines3.common.vec_env import DummyVecEnv, SubprocVecEnv
+from custom_environment_multistock import CustomStockTradingEnv, FEATURES
+from custom_environment_batched import BatchedStockEnv
 from data_extractor import get_stock_names
 
 
+@lru_cache(maxsize=None)
+def _load_stock(stock):
+    '''
+    Load the data for a stock, indexed by date.
+    The csv is converted to parquet the first time (or whenever the csv has been updated since),
+    so later runs skip parsing it, and within a run each stock is only loaded once.
+    Callers must not modify the returned dataframe, since it is shared.
+    '''
+    csv = f'data/{stock}.csv'
+    pq = f'data/{stock}.parquet'
+    if not os.path.exists(pq) or os.path.getmtime(pq) < os.path.getmtime(csv):
+        df = pd.read_csv(csv, parse_dates=["Date"]).set_index("Date")
+        # SB3 works in float32, so store the prices and indicators that way instead of pandas' float64
+        df = df.astype({c: np.float32 for c in df.select_dtypes(np.float64).columns})
+        df.to_parquet(pq)
+    return pd.read_parquet(pq)
+
+
+def build_feature_tensor(stocks, start_date, end_date, features=FEATURES, min_length=0):
+    '''
+    Stack the features of every stock over the given period into one C-contiguous float32 array
+    of shape (num_stocks, num_days, num_features), which is what the environments read from.
+    The technical indicators are already in the csv (see calculate_technical_indicators in data_extractor.py),
+    so this only slices and stacks them. Stocks with fewer than min_length days of data are left out.
+    end_date can be None or "Present" to go until the latest day.
+    The result is saved in data/cache, one file per set of arguments, which is rebuilt (overwritten)
+    whenever one of the csvs has been updated since, the same way _load_stock treats its parquet files.
+    '''
+    if end_date == "Present":
+        end_date = None
+    key = "|".join([",".join(stocks), str(start_date), str(end_date), ",".join(features), str(min_length)])
+    path = f"data/cache/{hashlib.md5(key.encode()).hexdigest()}.npy"
+    if os.path.exists(path) and all(os.path.getmtime(path) >= os.path.getmtime(f'data/{stock}.csv') for stock in stocks):
+        return np.load(path)
+
+    # Reading and parsing the files happens in C with the GIL released, so load the stocks in parallel
+    # (each one only once, so two threads never write the same parquet file)
+    unique_stocks = list(dict.fromkeys(stocks))
+    with ThreadPoolExecutor(max_workers=min(len(unique_stocks), os.cpu_count() or 1)) as executor:
+        loaded = dict(zip(unique_stocks, executor.map(_load_stock, unique_stocks)))
+
+    dfs = []
+    for stock in stocks:
+        df = loaded[stock]
+        # Do not use stocks that do not have enough data
+        if len(df) < min_length:
+            continue
+        dfs.append(df.loc[start_date:end_date, features])
+    data = np.ascontiguousarray(np.stack([df.to_numpy(dtype=np.float32) for df in dfs]))
+
+    if not os.path.exists("data/cache"):
+        os.mkdir("data/cache")
+    np.save(path, data)
+    return data
+
+
 def plot_portfolio(num_shares, stocks, start_date, end_date, name):
     '''
     Given the array of number of shares, plot the amount of each stock
     in the portfolio over time.    
     '''
-    plt.figure(figsize=(15, 6))
+    fig, ax = plt.subplots(figsize=(15, 6))
     num_shares = np.array(num_shares)
-    for i in range(num_shares.shape[1]):
-        plt.plot(range(num_shares.shape[0]), num_shares[:, i], label=stocks[i])
-    plt.title(f"Portfolio Shares, {name}")
-    plt.xlabel(f"Day {start_date} - {end_date}")
-    plt.ylabel("Number of Shares")
-    plt.legend()
-    plt.savefig(f"plots/portfolio_shares_{name}.png")
-    plt.show()
+    # A 2D array is drawn as one line per column (stock) in a single call
+    ax.plot(np.arange(num_shares.shape[0]), num_shares)
+    ax.set_title(f"Portfolio Shares, {name}")
+    ax.set_xlabel(f"Day {start_date} - {end_date}")
+    ax.set_ylabel("Number of Shares")
+    ax.legend(stocks)
+    fig.savefig(f"plots/portfolio_shares_{name}.png")
+    plt.close(fig)
+
+
+def make_env(data, window_size=10, k_value=1000, starting_balance=100000):
+    '''
+    Return a function that builds a fresh CustomStockTradingEnv.
+    SubprocVecEnv needs one of these per worker so every process owns its own environment.
+    '''
+    def _init():
+        return CustomStockTradingEnv(data, window_size=window_size, k=k_value, starting_balance=starting_balance)
+    return _init
+
+
+def make_shared_env(shm_name, shape, dtype, window_size=10, k_value=1000, starting_balance=100000):
+    '''
+    Like make_env, but the worker attaches to market data that the parent put in shared memory
+    instead of getting its own copy of every dataframe.
+    '''
+    def _init():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        env = CustomStockTradingEnv(data, window_size=window_size, k=k_value, starting_balance=starting_balance)
+        env.shm = shm # The view is only valid while the shared memory stays open
+        return env
+    return _init
+
+
+def make_vec_env(data, num_envs=1, vec_env="batched", window_size=10, k_value=1000, starting_balance=100000):
+    '''
+    Build the vectorized environment that SB3 collects rollouts from.
+    data: array of shape (num_stocks, num_days, num_features) from build_feature_tensor
+    vec_env: "batched" steps all num_envs portfolios together in one BatchedStockEnv,
+             "dummy" steps one CustomStockTradingEnv per copy in turn in this process (DummyVecEnv),
+             "subproc" runs one CustomStockTradingEnv per process (DummyVecEnv if num_envs is 1)
+    '''
+    if vec_env == "batched":
+        return BatchedStockEnv(data, num_envs=num_envs, window_size=window_size, k=k_value, starting_balance=starting_balance)
+    elif vec_env == "dummy":
+        return DummyVecEnv([make_env(data, window_size, k_value, starting_balance) for _ in range(num_envs)])
+    elif vec_env == "subproc":
+        if num_envs == 1:
+            return DummyVecEnv([make_env(data, window_size, k_value, starting_balance)])
+
+        # Put the market data in shared memory once, every worker reads from the same copy
+        shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+        np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[:] = data
+        try:
+            env_fns = [make_shared_env(shm.name, data.shape, data.dtype, window_size, k_value, starting_balance) for _ in range(num_envs)]
+            # Workers attach to the data by name, so any start method works (SB3 picks the platform's default)
+            env = SubprocVecEnv(env_fns)
+
+            # Once every worker has answered they have all attached, so the name can be removed
+            # (the memory itself is freed when the last worker exits)
+            env.get_attr("num_days")
+        finally:
+            # Also remove it if a worker failed to start, otherwise the segment outlives the run
+            shm.close()
+            shm.unlink()
+        return env
+    else:
+        raise ValueError("Please select batched, dummy or subproc")
+
+
+def run_episode(model, env, data, window_size=10, deterministic=True, batch_size=256):
+    '''
+    Run the model over the whole period once in every environment of env and return the
+    account balance, number of shares and total portfolio value at each step, averaged over the environments.
+    model: SB3 model, or just its policy (see load_model), to predict the actions with
+    deterministic: whether the model always takes its most likely action. If not, the actions are sampled from the policy,
+                   so with several environments the average is an estimate of how the stochastic policy does.
+    The observations only contain market data, so they do not depend on the actions taken,
+    and the actions for many steps can be predicted in one batched forward pass before stepping the env.
+    batch_size: max number of observations to predict at once, so the windows for a long period are never all in memory
+    '''
+    num_days = data.shape[1] # All the stocks cover the same days
+    num_envs = env.num_envs
+    # A deterministic model takes the same action in every environment, so each window only needs predicting once
+    steps_per_batch = batch_size if deterministic else max(batch_size // num_envs, 1)
+
+    env.reset()
+    for start in range(window_size, num_days - 1, steps_per_batch):
+        # The same windows the env returns, one for each step in this batch
+        windows = np.stack([data[:, t - window_size:t, :] for t in range(start, min(start + steps_per_batch, num_days - 1))])
+        if deterministic:
+            actions, _ = model.predict(windows, deterministic=True)
+            actions = np.repeat(actions[:, np.newaxis], num_envs, axis=1)
+        else:
+            actions, _ = model.predict(np.repeat(windows, num_envs, axis=0), deterministic=False)
+            actions = actions.reshape(-1, num_envs, *actions.shape[1:]) # Shape (num_steps, num_envs, num_stocks, 1)
+
+        for action in actions:
+            obs, reward, done, info = env.step(action)
+            if done[0]:
+                return {key: list(np.mean([env_info[key] for env_info in info], axis=0))
+                        for key in ("account_balance", "num_shares", "total_portfolio_value")}
+
+
+def load_model(trained_model, env):
+    '''
+    Load the policy of the model saved by train at the path "trained_model" for evaluation on env.
+    Predicting only needs the policy, so if its weights were saved on their own they are loaded into a bare MlpPolicy,
+    without building the rest of a PPO/A2C model (its rollout buffer in particular) or unpickling the saved SB3 object.
+    Models saved without them are loaded in full and only their policy is kept.
+    '''
+    if trained_model.endswith("PPO"):
+        model_class = PPO
+    elif trained_model.endswith("A2C"):
+        model_class = A2C
+    else:
+        raise ValueError("Please select PPO or A2C")
+
+    policy_path = f"{trained_model}_policy.pt"
+    if not os.path.exists(policy_path):
+        return model_class.load(trained_model, device="cpu").policy
+    # PPO and A2C use the same MlpPolicy network, and the learning rate is never used since it is not trained
+    policy = ActorCriticPolicy(env.observation_space, env.action_space, lr_schedule=lambda _: 0.0)
+    policy.load_state_dict(th.load(policy_path, map_location="cpu"))
+    return policy
 
 
 def train(stocks, start_date, end_date, training_period_length,
           model_name="PPO", features=["Date", "Close", "MACD", "Signal", "RSI", "CCI", "ADX"], 
-          window_size=10, k_value=1000, starting_balance=100000, gamma=0.99, num_timesteps=250):
+          window_size=10, k_value=1000, starting_balance=100000, gamma=0.99, num_timesteps=250, num_envs=1, vec_env="batched"):
     '''
     This function will train either A2C or PPO using the custom environment created in custom_environment.py.
     The model will be saved and can be loaded later for evaluation.
@@ -42,111 +230,90 @@ def train(stocks, start_date, end_date, training_period_length,
     window_size: int of window size to use, default is 10
     k_value: int of max number of shares to buy/sell at a time
     starting_balance: int of starting balance of account    
+    num_timesteps: int of steps each environment takes while training
+    num_envs: int of environments to collect rollouts from in parallel
+    vec_env: string of how to run them, either "batched" (all copies in one env), "dummy" (one env each, in turn),
+             or "subproc" (one process each)
     '''
-    dfs = [] # Shape (num_stocks, num_days, num_features)
-    for stock in stocks:
-        # Do not use stocks that do not have enough data
-        df = pd.read_csv(f'data/{stock}.csv')
-        if len(df) < training_period_length:
-            continue
-        df = df[(df["Date"] >= start_date) & (df["Date"] <= end_date)]
-        df = df[features]
-        df["Date"] = pd.to_datetime(df["Date"], format="%Y-%m-%d")
-        df.set_index("Date", inplace=True)
-        dfs.append(df)
-
-    env = CustomStockTradingEnv(dfs, window_size=window_size, k=k_value, starting_balance=starting_balance)
-    env = DummyVecEnv([lambda: env])
+    data = build_feature_tensor(stocks, start_date, end_date, features[1:], training_period_length) # Shape (num_stocks, num_days, num_features)
+    env = make_vec_env(data, num_envs, vec_env, window_size, k_value, starting_balance)
     
+    # n_steps is per environment, so PPO's is divided by num_envs to keep its 2048 step rollout the same size.
+    # A2C keeps its 5 step lookahead (which sets how far its returns are bootstrapped), so its rollout is 5 * num_envs steps
+    # The observations are small vectors, not images, so the policy trains faster on the CPU than on a GPU
     if model_name == "PPO":
-        model = PPO("MlpPolicy", env, gamma=gamma, verbose=0)
+        model = PPO("MlpPolicy", env, gamma=gamma, n_steps=max(2048 // num_envs, 2), device="cpu", verbose=0)
     elif model_name == "A2C":
-        model = A2C("MlpPolicy", env, gamma=gamma, verbose=0)
+        model = A2C("MlpPolicy", env, gamma=gamma, n_steps=5, device="cpu", verbose=0)
     else:
         raise ValueError("Please select PPO or A2C")
+    # total_timesteps counts the steps of every environment, so scale it up to walk each one num_timesteps days
+    # (otherwise adding environments would cut the number of updates, e.g. A2C would only do a quarter of them with 4)
     # eval_callback = EvalCallback(env, eval_freq=100, n_eval_episodes=5)
-    # model.learn(total_timesteps=num_timesteps, callback=[eval_callback])
-    model.learn(total_timesteps=num_timesteps)
+    # model.learn(total_timesteps=num_timesteps * num_envs, callback=[eval_callback])
+    model.learn(total_timesteps=num_timesteps * num_envs)
     
     # Save trained model (this is not the same way you save a Tensorflow model)
     if not os.path.exists("models"):
         os.mkdir("models")
     model.save(f"models/multistock_{model_name}")
+    # Also save just the policy weights, which is all evaluation needs (see load_model)
+    th.save(model.policy.state_dict(), f"models/multistock_{model_name}_policy.pt")
     print(f"Model saved as multistock_{model_name}")
 
-    obs = env.reset()
-    for i in range(np.array(dfs).shape[1]):
-        action, _ = model.predict(obs)
-        obs, reward, done, info = env.step(action)
-        if done:
-            info = info[0]
-            account_balances = info['account_balance']
-            num_shares = info['num_shares']
-            total_portfolio_value = info['total_portfolio_value']
-            break
+    env.close()
+
+    # Run the trained model deterministically over the training period once more, like evaluate does by default
+    # (learn always ends with an update, so every episode played while training was by an older policy)
+    env = make_vec_env(data, window_size=window_size, k_value=k_value, starting_balance=starting_balance)
+    info = run_episode(model, env, data, window_size)
+    env.close()
+    account_balances = info['account_balance']
+    num_shares = info['num_shares']
+    total_portfolio_value = info['total_portfolio_value']
 
     print("Account balance: {}".format(account_balances[-1]))
     print("Number of shares: {}".format(num_shares[-1]))
     print("Total portfolio value: {}".format(total_portfolio_value[-1]))
 
     # Plot training results
-    plt.figure(figsize=(15, 6))
-    plt.plot(total_portfolio_value, label='Portfolio value')
-    plt.title(f"Portfolio Value, Multistock")
-    plt.xlabel(f"Day {start_date} - {end_date}")
-    plt.ylabel("Portfolio Value ($)")
+    fig, ax = plt.subplots(figsize=(15, 6))
+    ax.plot(total_portfolio_value, label='Portfolio value')
+    ax.set_title(f"Portfolio Value, Multistock")
+    ax.set_xlabel(f"Day {start_date} - {end_date}")
+    ax.set_ylabel("Portfolio Value ($)")
 
     # Save plot
     if not os.path.exists("plots"):
         os.mkdir("plots")
-    plt.savefig(f"plots/training_multistock_{model_name}.png")
-    plt.show()
+    fig.savefig(f"plots/training_multistock_{model_name}.png")
+    plt.close(fig)
 
 
 def evaluate(stocks, start_date, end_date, testing_period_length, trained_model, 
              features=["Date", "Close", "MACD", "Signal", "RSI", "CCI", "ADX"], 
-             window_size=10, k_value=1000, starting_balance=100000):
+             window_size=10, k_value=1000, starting_balance=100000, num_envs=1, vec_env="batched", deterministic=True):
     '''
     Load the saved model from the path "trained_model" and evaluate it on the testing data.
     The testing data should be a period of time after the training data that the model has not seen.
+    With deterministic=False the actions are sampled from the policy, and with num_envs > 1 the results are averaged
+    over that many runs of it (see run_episode).
     '''
-    dfs = []
-    for stock in stocks:
-        df = pd.read_csv(f'data/{stock}.csv')
-        if len(df) < testing_period_length:
-            continue
-        if end_date is None or end_date == "Present":
-            df = df[df["Date"] >= start_date]
-            end_date = "Present"
-        else:
-            df = df[(df["Date"] >= start_date) & (df["Date"] <= end_date)]
-        df = df[features]
-        df["Date"] = pd.to_datetime(df["Date"], format="%Y-%m-%d")
-        df.set_index("Date", inplace=True)
-        dfs.append(df)
+    if end_date is None:
+        end_date = "Present"
+    data = build_feature_tensor(stocks, start_date, end_date, features[1:], testing_period_length)
     # Create the environment used to test the agent
-    env = CustomStockTradingEnv(dfs, window_size=window_size, k=k_value, starting_balance=starting_balance)
-    env = DummyVecEnv([lambda: env])
-    if trained_model.endswith("PPO"):
-        model = PPO.load(trained_model)
-    elif trained_model.endswith("A2C"):
-        model = A2C.load(trained_model)
-    else:
-        raise ValueError("Please select PPO or A2C")
+    env = make_vec_env(data, num_envs, vec_env, window_size, k_value, starting_balance)
+    model = load_model(trained_model, env)
     
     # Remember to set random seed for reproducibility
-    model.set_random_seed(0)
+    set_random_seed(0)
     
-    obs = env.reset()
-    for i in range(np.array(dfs).shape[1]):
-        action, _ = model.predict(obs)
-        obs, reward, done, info = env.step(action)
-        if done:
-            info = info[0]
-            account_balances = info['account_balance']
-            num_shares = info['num_shares']
-            total_portfolio_value = info['total_portfolio_value']
-            break
+    info = run_episode(model, env, data, window_size, deterministic)
+    env.close()
+    account_balances = info['account_balance']
+    num_shares = info['num_shares']
+    total_portfolio_value = info['total_portfolio_value']
 
     # Length is len(df) - window_size = 46
     # print(len(df), len(total_portfolio_value))
@@ -157,97 +324,66 @@ def evaluate(stocks, start_date, end_date, testing_period_length, trained_model,
     print("Total portfolio value: {}".format(total_portfolio_value[-1]))
 
     # Plot testing results
-    plt.figure(figsize=(15, 6))
-    plt.plot(total_portfolio_value, label='Portfolio value')
-    plt.title(f"Portfolio Value, {trained_model[-3:]} Multistock")
-    plt.xlabel(f"Day {start_date} - {end_date}")
-    plt.ylabel("Portfolio Value ($)")
-    plt.savefig(f"plots/testing_multistock_{trained_model.split('_')[-1]}.png")
-    plt.show()
+    fig, ax = plt.subplots(figsize=(15, 6))
+    ax.plot(total_portfolio_value, label='Portfolio value')
+    ax.set_title(f"Portfolio Value, {trained_model[-3:]} Multistock")
+    ax.set_xlabel(f"Day {start_date} - {end_date}")
+    ax.set_ylabel("Portfolio Value ($)")
+    fig.savefig(f"plots/testing_multistock_{trained_model.split('_')[-1]}.png")
+    plt.close(fig)
 
     plot_portfolio(num_shares, stocks, start_date, end_date, trained_model[-3:])
 
 
 def evaluate_both(stocks, start_date, end_date, testing_period_length, trained_model1, trained_model2,
              features=["Date", "Close", "MACD", "Signal", "RSI", "CCI", "ADX"], 
-             window_size=10, k_value=1000, starting_balance=100000):
+             window_size=10, k_value=1000, starting_balance=100000, num_envs=1, vec_env="batched", deterministic=True):
     '''
     Load the saved model from the path "trained_model" and evaluate it on the testing data.
     The testing data should be a period of time after the training data that the model has not seen.
+    With deterministic=False the actions are sampled from the policy, and with num_envs > 1 the results are averaged
+    over that many runs of it (see run_episode).
     '''
-    dfs = []
-    for stock in stocks:
-        df = pd.read_csv(f'data/{stock}.csv')
-        if len(df) < testing_period_length:
-            continue
-        if end_date is None or end_date == "Present":
-            df = df[df["Date"] >= start_date]
-            end_date = "Present"
-        else:
-            df = df[(df["Date"] >= start_date) & (df["Date"] <= end_date)]
-        df = df[features]
-        df["Date"] = pd.to_datetime(df["Date"], format="%Y-%m-%d")
-        df.set_index("Date", inplace=True)
-        dfs.append(df)
+    if end_date is None:
+        end_date = "Present"
+    data = build_feature_tensor(stocks, start_date, end_date, features[1:], testing_period_length)
+
+    # Both models are tested on the same env, run_episode resets it before each run
+    env = make_vec_env(data, num_envs, vec_env, window_size, k_value, starting_balance)
 
     # Test model 1
-    env = CustomStockTradingEnv(dfs, window_size=window_size, k=k_value, starting_balance=starting_balance)
-    env = DummyVecEnv([lambda: env])
-    if trained_model1.endswith("PPO"):
-        model1 = PPO.load(trained_model1)
-    elif trained_model1.endswith("A2C"):
-        model1 = A2C.load(trained_model1)
-    else:
-        raise ValueError("Please select PPO or A2C")
+    model1 = load_model(trained_model1, env)
     
     # Remember to set random seed for reproducibility
-    model1.set_random_seed(0)
+    set_random_seed(0)
     
-    obs = env.reset()
-    for i in range(np.array(dfs).shape[1]):
-        action, _ = model1.predict(obs)
-        obs, reward, done, info = env.step(action)
-        if done:
-            info = info[0]
-            account_balances1 = info['account_balance']
-            num_shares1 = info['num_shares']
-            total_portfolio_value1 = info['total_portfolio_value']
-            break
+    info = run_episode(model1, env, data, window_size, deterministic)
+    account_balances1 = info['account_balance']
+    num_shares1 = info['num_shares']
+    total_portfolio_value1 = info['total_portfolio_value']
     
     # Test model 2
-    env = CustomStockTradingEnv(dfs, window_size=window_size, k=k_value, starting_balance=starting_balance)
-    env = DummyVecEnv([lambda: env])
-    if trained_model2.endswith("PPO"):
-        model2 = PPO.load(trained_model2)
-    elif trained_model2.endswith("A2C"):
-        model2 = A2C.load(trained_model2)
-    else:
-        raise ValueError("Please select PPO or A2C")
+    model2 = load_model(trained_model2, env)
     
     # Remember to set random seed for reproducibility
-    model2.set_random_seed(0)
+    set_random_seed(0)
     
-    obs = env.reset()
-    for i in range(np.array(dfs).shape[1]):
-        action, _ = model2.predict(obs)
-        obs, reward, done, info = env.step(action)
-        if done:
-            info = info[0]
-            account_balances2 = info['account_balance']
-            num_shares2 = info['num_shares']
-            total_portfolio_value2 = info['total_portfolio_value']
-            break
+    info = run_episode(model2, env, data, window_size, deterministic)
+    env.close()
+    account_balances2 = info['account_balance']
+    num_shares2 = info['num_shares']
+    total_portfolio_value2 = info['total_portfolio_value']
 
     # Plot testing results
-    plt.figure(figsize=(15, 6))
-    plt.plot(total_portfolio_value1, label='Portfolio Value (A2C)')
-    plt.plot(total_portfolio_value2, label='Portfolio Value (PPO)')
-    plt.title(f"Portfolio Value, Multistock")
-    plt.xlabel(f"Day {start_date} - {end_date}")
-    plt.ylabel("Portfolio Value ($)")
-    plt.legend(loc="best")
-    plt.savefig(f"plots/testing_multistock_ensemble.png")
-    plt.show()
+    fig, ax = plt.subplots(figsize=(15, 6))
+    ax.plot(total_portfolio_value1, label='Portfolio Value (A2C)')
+    ax.plot(total_portfolio_value2, label='Portfolio Value (PPO)')
+    ax.set_title(f"Portfolio Value, Multistock")
+    ax.set_xlabel(f"Day {start_date} - {end_date}")
+    ax.set_ylabel("Portfolio Value ($)")
+    ax.legend(loc="best")
+    fig.savefig(f"plots/testing_multistock_ensemble.png")
+    plt.close(fig)
 
 if __name__ == "__main__":
     # Training 
@@ -257,10 +393,10 @@ if __name__ == "__main__":
     end_train = "2023-01-01"
 
     # We need to calculate the training period length to cut out stocks that don't have enough data
-    # We'll use AAPL as a reference
-    df = pd.read_csv(f'data/AAPL.csv')
-    df = df[(df["Date"] >= start_train) & (df["Date"] <= end_train)]
-    training_period_length = len(df)
+    # We'll use AAPL as a reference, its dates are sorted so the period is found by binary search on the index
+    reference_dates = _load_stock("AAPL").index
+    training_period = reference_dates.slice_indexer(start_train, end_train)
+    training_period_length = training_period.stop - training_period.start
 
     model = "A2C"
     features = ["Date", "Close", "MACD", "Signal", "RSI", "CCI", "ADX"]
@@ -269,21 +405,18 @@ if __name__ == "__main__":
     starting_balance = 100000
     gamma = 0.95
     num_timesteps = 250
-    train(stocks, start_train, end_train, training_period_length, model, features, window_size, k_value, starting_balance, gamma, num_timesteps)
+    num_envs = 4
+    vec_env = "batched" # Or "subproc" for one process per env, see make_vec_env
+    train(stocks, start_train, end_train, training_period_length, model, features, window_size, k_value, starting_balance, gamma, num_timesteps, num_envs, vec_env)
 
     model = "PPO"
-    train(stocks, start_train, end_train, training_period_length, model, features, window_size, k_value, starting_balance, gamma, num_timesteps)
+    train(stocks, start_train, end_train, training_period_length, model, features, window_size, k_value, starting_balance, gamma, num_timesteps, num_envs, vec_env)
 
     # Evaluation
     start_test = "2023-01-01"
-    end_test = None
-    df = pd.read_csv(f'data/AAPL.csv')
-    if end_test is None or end_test == "Present":
-        df = df[df["Date"] >= start_test]
-        end_test = "Present"
-    else:
-        df = df[(df["Date"] >= start_test) & (df["Date"] <= end_test)]
-    testing_period_length = len(df)
+    end_test = None # Until the latest day, evaluate labels it "Present"
+    testing_period = reference_dates.slice_indexer(start_test, end_test)
+    testing_period_length = testing_period.stop - testing_period.start
     trained_model = f"models/multistock_A2C"
     evaluate(stocks, start_test, end_test, testing_period_length, trained_model, features, window_size, k_value, starting_balance)
     
@@ -26,9 +26,8 @@ def train(stock, start_date, end_date,
     '''
     df = pd.read_csv(f'data/{stock}.csv')
     df = df[(df["Date"] >= start_date) & (df["Date"] <= end_date)]
-    df = df[features]
-    df["Date"] = pd.to_datetime(df["Date"], format="%Y-%m-%d")
-    df.set_index("Date", inplace=True)
+    # The env only reads the feature columns, so the dates do not need to be parsed into an index
+    df = df[features[1:]].reset_index(drop=True)
 
     env = CustomStockTradingEnv(df, window_size=window_size, k=k_value, starting_balance=starting_balance)
     env = DummyVecEnv([lambda: env])
@@ -90,9 +89,8 @@ def evaluate(stock, start_date, end_date, trained_model,
     else:
         df = df[(df["Date"] >= "2023-01-01")]
         end_date = "Present"
-    df = df[features]
-    df["Date"] = pd.to_datetime(df["Date"], format="%Y-%m-%d")
-    df.set_index("Date", inplace=True)
+    # The env only reads the feature columns, so the dates do not need to be parsed into an index
+    df = df[features[1:]].reset_index(drop=True)
 
     # Create the environment used to test the agent
     env = CustomStockTradingEnv(df, window_size=window_size, k=k_value, starting_balance=starting_balance)
@@ -149,9 +147,8 @@ def evaluate_both(stock, start_date, end_date, trained_model1, trained_model2,
     else:
         df = df[(df["Date"] >= "2023-01-01")]
         end_date = "Present"
-    df = df[features]
-    df["Date"] = pd.to_datetime(df["Date"], format="%Y-%m-%d")
-    df.set_index("Date", inplace=True)
+    # The env only reads the feature columns, so the dates do not need to be parsed into an index
+    df = df[features[1:]].reset_index(drop=True)
 
     # We test the first trained model (A2C)
     env = CustomStockTradingEnv(df, window_size=window_size, k=k_value, starting_balance=starting_balance)